@@ -2,16 +2,36 @@ import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
 import os
+import glob
+import multiprocessing as mp
 from datetime import datetime, time
 
 class CleanBookmapVisualizer:
+    # Bump whenever the cleaned frame layout changes, so stale Parquet caches are ignored
+    CACHE_VERSION = 1
+    
     def __init__(self, min_order_size: int = 20):
         self.min_order_size = min_order_size
+        
+        # Resolve 5-level order book column names once
+        chinese_nums = ['一', '二', '三', '四', '五']
+        self._bid_px_cols = [f'买{num}价' for num in chinese_nums]
+        self._ask_px_cols = [f'卖{num}价' for num in chinese_nums]
+        self._bid_vol_cols = [f'买{num}量' for num in chinese_nums]
+        self._ask_vol_cols = [f'卖{num}量' for num in chinese_nums]
     
     def load_and_clean_data(self, filepath: str) -> pd.DataFrame:
         """Load and clean L2 data with proper time filtering"""
-        # Load data with GBK encoding
-        df = pd.read_csv(filepath, encoding='gbk')
+        # Reuse the cleaned frame cached next to the CSV, keyed on the exact source size and mtime
+        # (a replaced file with a preserved older mtime, e.g. from cp -p or rsync -t, still misses)
+        stat = os.stat(filepath)
+        cache_path = f'{filepath}.v{self.CACHE_VERSION}.{stat.st_size}-{stat.st_mtime_ns}.parquet'
+        if os.path.exists(cache_path):
+            try:
+                return pd.read_parquet(cache_path)
+            except (ImportError, OSError, ValueError):
+                # Missing parquet engine or corrupt cache: fall through and re-parse the CSV
+                pass
         
         # Standardize column names
         expected_cols = [
@@ -22,34 +42,90 @@ class CleanBookmapVisualizer:
             '卖一量', '卖二量', '卖三量', '卖四量', '卖五量'
         ]
         
-        if len(df.columns) == len(expected_cols):
-            df.columns = expected_cols
+        header = pd.read_csv(filepath, encoding='gbk', nrows=0).columns
+        names = expected_cols if len(header) == len(expected_cols) else list(header)
         
-        # Convert time and numeric columns
-        df['时间'] = pd.to_datetime(df['时间'])
+        # Only keep the columns used by the visualizer (drops 市场代码, 证券代码, 成交笔数, 成交额, 方向)
+        numeric_cols = ['最新价', '成交量'] + \
+                      self._bid_px_cols + self._ask_px_cols + \
+                      self._bid_vol_cols + self._ask_vol_cols
+        usecols = [col for col in ['时间'] + numeric_cols if col in names]
+        
+        # Numeric columns are typed by the parser directly
+        # A-share prices and order sizes fit in float32; cumulative volume keeps float64 so tick diffs stay exact
+        dtype_map = {col: 'float64' if col == '成交量' else 'float32' for col in numeric_cols if col in names}
+        
+        # Load data with GBK encoding, converting time and numeric columns on read
+        read_kwargs = dict(encoding='gbk', header=0, names=names, usecols=usecols, parse_dates=['时间'])
+        
+        try:
+            df = self._read_market_hours(filepath, dict(read_kwargs, dtype=dtype_map))
+        except ValueError:
+            # Malformed numeric cells (e.g. '--'): re-read untyped and coerce them to NaN
+            df = self._read_market_hours(filepath, read_kwargs)
+            coerce_cols = list(dtype_map)
+            df[coerce_cols] = df[coerce_cols].apply(pd.to_numeric, errors='coerce').astype(dtype_map)
         
-        # Filter to market hours only (9:25-15:00)
-        market_start = time(9, 25)
-        market_end = time(15, 0)
-        df = df[
-            (df['时间'].dt.time >= market_start) & 
-            (df['时间'].dt.time <= market_end)
-        ].copy()
-        
-        # Convert numeric columns
-        numeric_cols = ['最新价', '成交笔数', '成交额', '成交量'] + \
-                      ['买一价', '买二价', '买三价', '买四价', '买五价'] + \
-                      ['卖一价', '卖二价', '卖三价', '卖四价', '卖五价'] + \
-                      ['买一量', '买二量', '买三量', '买四量', '买五量'] + \
-                      ['卖一量', '卖二量', '卖三量', '卖四量', '卖五量']
-        
-        for col in numeric_cols:
-            if col in df.columns:
-                df[col] = pd.to_numeric(df[col], errors='coerce')
         df = df.reset_index(drop=True)
         assert isinstance(df, pd.DataFrame)
+        
+        # Cache cleaned data for subsequent runs (requires pyarrow or fastparquet)
+        # Write to a temp file first so an interrupted run never leaves a truncated cache behind
+        tmp_path = cache_path + '.tmp'
+        try:
+            df.to_parquet(tmp_path, compression='zstd')
+            os.replace(tmp_path, cache_path)
+        except (ImportError, OSError):
+            if os.path.exists(tmp_path):
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+        else:
+            # Drop caches of earlier versions of this CSV so they don't pile up next to it
+            for stale_path in glob.glob(glob.escape(filepath) + '.v*.parquet'):
+                if stale_path != cache_path:
+                    try:
+                        os.remove(stale_path)
+                    except OSError:
+                        pass
         return df
     
+    def _read_market_hours(self, filepath: str, read_kwargs: dict) -> pd.DataFrame:
+        """Read a CSV and keep only rows within market hours"""
+        if os.path.getsize(filepath) > 50 * 1024 * 1024:
+            # Stream large files in chunks, dropping off-hours rows before they accumulate
+            reader = pd.read_csv(filepath, engine='c', chunksize=200_000, **read_kwargs)
+            return pd.concat([chunk[self._market_hours_mask(chunk)] for chunk in reader])
+        
+        # Multithreaded Arrow CSV reader when pyarrow is available
+        # Its engine rejects dtype together with names/usecols, so the columns are cast after the read
+        arrow_kwargs = {key: value for key, value in read_kwargs.items() if key != 'dtype'}
+        try:
+            df = pd.read_csv(filepath, engine='pyarrow', **arrow_kwargs)
+        except ImportError:
+            df = None
+        except ValueError as e:
+            print(f"pyarrow could not read {os.path.basename(filepath)} ({e}), using the C parser")
+            df = None
+        
+        if df is None:
+            df = pd.read_csv(filepath, engine='c', low_memory=False, cache_dates=True, **read_kwargs)
+        elif 'dtype' in read_kwargs:
+            # Malformed numeric cells raise ValueError here and are handled by the caller
+            df = df.astype(read_kwargs['dtype'])
+        
+        return df[self._market_hours_mask(df)]
+    
+    def _market_hours_mask(self, df: pd.DataFrame) -> np.ndarray:
+        """Boolean mask of rows within market hours only (9:25-15:00)"""
+        market_start = time(9, 25)
+        market_end = time(15, 0)
+        # Same inclusive range as between_time, compared on int64 timestamps instead of datetime.time objects
+        mask = np.zeros(len(df), dtype=bool)
+        mask[pd.DatetimeIndex(df['时间']).indexer_between_time(market_start, market_end)] = True
+        return mask
+    
     def calculate_coordinates(self, df: pd.DataFrame):
         """Pre-calculate all coordinates for unified plotting"""
         n_points = len(df)
@@ -108,271 +184,233 @@ class CleanBookmapVisualizer:
         
         return coords
     
+    def calculate_tick_features(self, df: pd.DataFrame):
+        """Pre-calculate tick-by-tick trade features shared by all trade-based plots"""
+        volume_diff = df['成交量'].diff().to_numpy(dtype=float)
+        price_diff = df['最新价'].diff().to_numpy(dtype=float)
+        last_prices = df['最新价'].to_numpy(dtype=float)
+        ask_prices = df['卖一价'].to_numpy(dtype=float) if '卖一价' in df.columns else np.full(len(df), np.nan)
+        bid_prices = df['买一价'].to_numpy(dtype=float) if '买一价' in df.columns else np.full(len(df), np.nan)
+        
+        # Active BUY orders execute at ASK price (卖一价) - taking liquidity from sellers
+        # Active SELL orders execute at BID price (买一价) - taking liquidity from buyers
+        is_buy = price_diff > 0
+        quote_prices = np.where(is_buy, ask_prices, bid_prices)
+        
+        # Fall back to last price if the quote is missing
+        estimated = np.isnan(quote_prices)
+        execution_prices = np.where(estimated, last_prices, quote_prices)
+        
+        # Filter for meaningful volume changes (shared threshold for bubbles and volume bars)
+        significant_mask = (volume_diff > 50) & ~np.isnan(volume_diff)
+        
+        features = {
+            'volume_diff': volume_diff,
+            'price_diff': price_diff,
+            'last_prices': last_prices,
+            'is_buy': is_buy,
+            'estimated': estimated,
+            'execution_prices': execution_prices,
+            'significant_mask': significant_mask
+        }
+        
+        return features
+    
     def create_support_resistance_heatmap(self, df: pd.DataFrame, coords: dict):
-        """Create support/resistance heatmap shapes"""
-        chinese_nums = ['一', '二', '三', '四', '五']
-        shapes = []
+        """Create support/resistance heatmap trace"""
+        # Resolve level columns present in this frame (bid levels, then ask levels)
+        level_cols = [
+            (px_col, vol_col)
+            for px_col, vol_col in zip(self._bid_px_cols + self._ask_px_cols, self._bid_vol_cols + self._ask_vol_cols)
+            if px_col in df.columns and vol_col in df.columns
+        ]
+        n_bid_levels = sum(px_col in self._bid_px_cols for px_col, _ in level_cols)
+        px_idx = df.columns.get_indexer([px_col for px_col, _ in level_cols])
+        vol_idx = df.columns.get_indexer([vol_col for _, vol_col in level_cols])
         
         # Calculate daily max order size for normalization
-        max_order_size = 0
-        for num in chinese_nums:
-            for side in ['买', '卖']:
-                volume_col = f'{side}{num}量'
-                if volume_col in df.columns:
-                    col_max = df[volume_col].max()
-                    if col_max == col_max:  # NaN check
-                        max_order_size = max(max_order_size, col_max)
+        volume_cols = [col for col in self._bid_vol_cols + self._ask_vol_cols if col in df.columns]
+        all_volumes = df[volume_cols].to_numpy(dtype=float)
+        max_order_size = np.nanmax(all_volumes) if np.isfinite(all_volumes).any() else 0
         max_order_size = max(max_order_size, 100)
         
-        # Create limited number of heatmap shapes for performance
-        # Sample data points and price levels to limit shapes
+        # Create limited heatmap grid for performance
+        # Sample data points and price levels to limit cells
         max_time_samples = 60*4
         max_price_samples = 100
         
         time_sample_step = max(1, coords['n_points'] // max_time_samples)
-        time_samples = range(0, coords['n_points'], time_sample_step)
-        
-        # Use larger price step for better performance
-        price_step = max(0.01, coords['daily_price_range'] / max_price_samples)
-        price_bins = np.arange(coords['daily_price_min'], coords['daily_price_max'] + price_step, price_step)
+        time_samples = np.arange(0, coords['n_points'], time_sample_step)
+        
+        # Use larger price step for better performance (price bins in integer cents)
+        daily_price_min_cents = int(round(coords['daily_price_min'] * 100))
+        daily_price_max_cents = int(round(coords['daily_price_max'] * 100))
+        price_step_cents = max(1, int(round((daily_price_max_cents - daily_price_min_cents) / max_price_samples)))
+        # Pad one bin on each side so book levels just outside the traded range are still drawn
+        price_base_cents = daily_price_min_cents - price_step_cents
+        price_bins = np.arange(price_base_cents, daily_price_max_cents + 2 * price_step_cents, price_step_cents) / 100
+        
+        # Only process sampled time points, extracted as (time samples x levels) matrices by position
+        level_px = df.iloc[::time_sample_step, px_idx].to_numpy(dtype=np.float32)
+        level_vol = df.iloc[::time_sample_step, vol_idx].to_numpy(dtype=np.float32)
+        is_bid = np.arange(len(level_cols)) < n_bid_levels
+        
+        # Find closest price bin in integer cents (no float epsilon at bin edges)
+        valid = ~np.isnan(level_px) & ~np.isnan(level_vol) & (level_vol >= self.min_order_size)
+        price_cents = np.rint(np.where(valid, level_px, 0) * 100).astype(np.int64)
+        price_idx = (price_cents - price_base_cents + price_step_cents // 2) // price_step_cents
+        valid &= (price_idx >= 0) & (price_idx < len(price_bins))
+        
+        if not valid.any():
+            return None
         
-        # Only process sampled time points
-        for t_idx in time_samples:
-            row = df.iloc[t_idx]
-            
-            # Process bid levels
-            for num in chinese_nums:
-                price_col = f'买{num}价'
-                volume_col = f'买{num}量'
-                if price_col in df.columns and volume_col in df.columns:
-                    price = row[price_col]
-                    volume = row[volume_col]
-                    if not pd.isna(price) and not pd.isna(volume) and volume >= self.min_order_size:
-                        # Find closest price bin
-                        price_idx = int((price - coords['daily_price_min']) / price_step)
-                        if 0 <= price_idx < len(price_bins):
-                            opacity = min(0.8, volume / max_order_size)
-                            shapes.append({
-                                'type': 'rect',
-                                'x0': t_idx - time_sample_step/2,
-                                'x1': t_idx + time_sample_step/2,
-                                'y0': price - price_step/2,
-                                'y1': price + price_step/2,
-                                'fillcolor': f'rgba(0,255,0,{opacity})',
-                                'line': dict(width=0),
-                                'layer': 'below'
-                            })
-            
-            # Process ask levels
-            for num in chinese_nums:
-                price_col = f'卖{num}价'
-                volume_col = f'卖{num}量'
-                if price_col in df.columns and volume_col in df.columns:
-                    price = row[price_col]
-                    volume = row[volume_col]
-                    if not pd.isna(price) and not pd.isna(volume) and volume >= self.min_order_size:
-                        # Find closest price bin
-                        price_idx = int((price - coords['daily_price_min']) / price_step)
-                        if 0 <= price_idx < len(price_bins):
-                            opacity = min(0.8, volume / max_order_size)
-                            shapes.append({
-                                'type': 'rect',
-                                'x0': t_idx - time_sample_step/2,
-                                'x1': t_idx + time_sample_step/2,
-                                'y0': price - price_step/2,
-                                'y1': price + price_step/2,
-                                'fillcolor': f'rgba(255,0,0,{opacity})',
-                                'line': dict(width=0),
-                                'layer': 'below'
-                            })
-        
-        return shapes
+        # Rasterize cells onto the sampled time x price grid (+opacity for bids, -opacity for asks)
+        # Several levels can share a cell, so each side keeps its strongest level (fmax.at is
+        # unbuffered and ignores the NaN fill); asks then win over bids as they were drawn on top
+        t_pos, level = np.nonzero(valid)
+        opacity = np.minimum(0.8, level_vol[t_pos, level] / max_order_size)
+        cell = (price_idx[t_pos, level], t_pos)
+        side_z = {}
+        for side, side_mask in (('bid', is_bid[level]), ('ask', ~is_bid[level])):
+            side_z[side] = np.full((len(price_bins), len(time_samples)), np.nan)
+            np.fmax.at(side_z[side], (cell[0][side_mask], cell[1][side_mask]), opacity[side_mask])
+        z = np.where(np.isnan(side_z['ask']), side_z['bid'], -side_z['ask'])
+        
+        return go.Heatmap(
+            x=time_samples,
+            y=price_bins,
+            z=z,
+            zmin=-0.8,
+            zmax=0.8,
+            # Each side fades only in alpha (split at zero) so cells keep their full red/green like rgba shapes
+            colorscale=[
+                [0, 'rgba(255,0,0,0.8)'], [0.5, 'rgba(255,0,0,0)'],
+                [0.5, 'rgba(0,255,0,0)'], [1, 'rgba(0,255,0,0.8)']
+            ],
+            showscale=False,
+            name='Support/Resistance',
+            showlegend=False,
+            hoverinfo='skip'
+        )
     
-    def create_vertical_volume_bars(self, df: pd.DataFrame, coords: dict):
-        """Create vertical volume bar shapes - consistent with trade bubble granularity"""
-        shapes = []
-        
-        # Use same tick-by-tick calculation as trade bubbles for consistency
-        volume_diff = df['成交量'].diff()
-        price_diff = df['最新价'].diff()
-        
-        # Filter for meaningful volume changes (same threshold as bubbles)
-        significant_volume_mask = (volume_diff > 50) & ~volume_diff.isna()
+    def create_vertical_volume_bars(self, df: pd.DataFrame, coords: dict, features: dict):
+        """Create vertical volume bar trace - consistent with trade bubble granularity"""
+        # Use same tick-by-tick features as trade bubbles for consistency
+        significant_volume_mask = features['significant_mask']
         
         if not significant_volume_mask.any():
-            return shapes
+            return None
         
         # Get significant volume data
         significant_indices = coords['time_coords'][significant_volume_mask]
-        significant_volumes = volume_diff[significant_volume_mask]
-        significant_price_changes = price_diff[significant_volume_mask]
-        
-        # Convert to arrays for consistent indexing
-        assert isinstance(significant_volumes, pd.Series)
-        assert isinstance(significant_price_changes, pd.Series)
-        significant_volumes_array = significant_volumes.values
-        significant_price_changes_array = significant_price_changes.values
+        significant_volumes = features['volume_diff'][significant_volume_mask]
+        significant_price_changes = features['price_diff'][significant_volume_mask]
         
         # Aggregate nearby trades to reduce visual clutter
         aggregation_window = max(1, coords['n_points'] // 200)  # Aggregate within small windows
-        aggregated_data = []
-        
-        i = 0
-        while i < len(significant_indices):
-            window_start = significant_indices[i]
-            window_volume = 0
-            window_price_change = 0
-            window_end = window_start
-            
-            # Aggregate all trades within the window
-            while i < len(significant_indices) and significant_indices[i] <= window_start + aggregation_window:
-                window_volume += significant_volumes_array[i]
-                window_price_change += significant_price_changes_array[i]
-                window_end = significant_indices[i]
-                i += 1
-            
-            window_center = (window_start + window_end) / 2
-            aggregated_data.append((window_center, window_volume, window_price_change))
         
-        if not aggregated_data:
-            return shapes
+        # Significant indices are sorted, so each window is a contiguous run of trades
+        window_ids = significant_indices // aggregation_window
+        window_starts = np.flatnonzero(np.diff(window_ids, prepend=-1))
+        window_ends = np.append(window_starts[1:], len(window_ids)) - 1
         
-        # Extract aggregated data
-        x_positions = [data[0] for data in aggregated_data]
-        volumes = [data[1] for data in aggregated_data]
-        price_changes = [data[2] for data in aggregated_data]
+        x_positions = (significant_indices[window_starts] + significant_indices[window_ends]) / 2
+        volumes = np.add.reduceat(significant_volumes, window_starts)
+        price_changes = np.add.reduceat(significant_price_changes, window_starts)
         
         # Normalize heights
-        max_volume = max(volumes)
+        max_volume = volumes.max()
         bar_width = aggregation_window * 0.8
-        
-        for x_pos, volume, price_change in aggregated_data:
-            height = (volume / max_volume) * coords['volume_bar_height']
-            color = 'green' if price_change >= 0 else 'red'
-            
-            shapes.append({
-                'type': 'rect',
-                'x0': x_pos - bar_width/2,
-                'x1': x_pos + bar_width/2,
-                'y0': coords['volume_bar_y_base'],
-                'y1': coords['volume_bar_y_base'] + height,
-                'fillcolor': color,
-                'opacity': 0.7,
-                'line': dict(width=0)
-            })
-        
-        return shapes
+        heights = (volumes / max_volume) * coords['volume_bar_height']
+        colors = np.where(price_changes >= 0, 'green', 'red')
+        
+        return go.Bar(
+            x=x_positions,
+            y=heights,
+            base=coords['volume_bar_y_base'],
+            width=bar_width,
+            marker=dict(color=colors, line=dict(width=0)),
+            opacity=0.7,
+            name='Volume',
+            showlegend=False,
+            hoverinfo='skip'
+        )
     
-    def create_horizontal_volume_profile(self, df: pd.DataFrame, coords: dict):
-        """Create horizontal volume profile shapes - using exact execution prices"""
-        shapes = []
-        
+    def create_horizontal_volume_profile(self, df: pd.DataFrame, coords: dict, features: dict):
+        """Create horizontal volume profile trace - using exact execution prices"""
         # Collect volumes at exact execution prices (no binning)
-        price_volumes = {}  # execution_price -> {'buy': volume, 'sell': volume}
+        volume_delta = features['volume_diff']
+        price_change = features['price_diff']
+        trade_mask = (volume_delta > 0) & ~np.isnan(volume_delta)
+        
+        if not trade_mask.any():
+            return None
+        
+        # Use same execution price logic as trade bubbles
+        execution_prices = features['execution_prices']
+        
+        # Round to 0.01 precision for grouping (integer cents)
+        price_cents = np.rint(execution_prices * 100).astype(np.int64)
+        buy_mask = trade_mask & (price_change >= 0)
+        sell_mask = trade_mask & ~(price_change >= 0)
+        
+        base_cents = price_cents[trade_mask].min()
+        n_bins = price_cents[trade_mask].max() - base_cents + 1
+        buy_volumes = np.bincount(price_cents[buy_mask] - base_cents, weights=volume_delta[buy_mask], minlength=n_bins)
+        sell_volumes = np.bincount(price_cents[sell_mask] - base_cents, weights=volume_delta[sell_mask], minlength=n_bins)
         
-        for i in range(1, coords['n_points']):
-            volume_delta = df.iloc[i]['成交量'] - df.iloc[i-1]['成交量']
-            price_change = df.iloc[i]['最新价'] - df.iloc[i-1]['最新价']
-            
-            if pd.isna(volume_delta) or volume_delta <= 0:
-                continue
-            
-            # Use same execution price logic as trade bubbles
-            if price_change > 0:
-                # Active BUY = executed at ASK price
-                if '卖一价' in df.columns and not pd.isna(df['卖一价'].iloc[i]):
-                    execution_price = df['卖一价'].iloc[i]
-                else:
-                    execution_price = df['最新价'].iloc[i]
-            else:
-                # Active SELL = executed at BID price  
-                if '买一价' in df.columns and not pd.isna(df['买一价'].iloc[i]):
-                    execution_price = df['买一价'].iloc[i]
-                else:
-                    execution_price = df['最新价'].iloc[i]
-            
-            # Round to 0.01 precision for grouping
-            rounded_price = round(execution_price, 2)
-            
-            # Initialize if not seen before
-            if rounded_price not in price_volumes:
-                price_volumes[rounded_price] = {'buy': 0, 'sell': 0}
-            
-            # Add volume to appropriate category
-            if price_change >= 0:
-                price_volumes[rounded_price]['buy'] += volume_delta
-            else:
-                price_volumes[rounded_price]['sell'] += volume_delta
-        
-        # Create separate volume profile bars for active buy and active sell
-        if not price_volumes:
-            return shapes
-            
         # Find max volume for scaling
-        max_buy_volume = max((vol['buy'] for vol in price_volumes.values()), default=0)
-        max_sell_volume = max((vol['sell'] for vol in price_volumes.values()), default=0)
-        max_volume = max(max_buy_volume, max_sell_volume)
+        max_volume = max(buy_volumes.max(), sell_volumes.max())
         
         if max_volume == 0:
-            return shapes
+            return None
         
         # Each half gets 20% of the main chart width (half of the 40% volume profile area)
         max_bar_width = coords['volume_profile_width'] / 2 * 0.9  # 90% of half-width for bars
         price_step = 0.01  # Height of each volume bar
         
-        for execution_price, volumes in price_volumes.items():
-            buy_vol = volumes['buy']
-            sell_vol = volumes['sell']
-            
-            # Active BUY volume bar (green, extends right from center)
-            if buy_vol > 0:
-                bar_width = (buy_vol / max_volume) * max_bar_width
-                shapes.append({
-                    'type': 'rect',
-                    'x0': coords['volume_profile_center'],
-                    'x1': coords['volume_profile_center'] + bar_width,
-                    'y0': execution_price - price_step/2,
-                    'y1': execution_price + price_step/2,
-                    'fillcolor': 'green',
-                    'opacity': 0.7,
-                    'line': dict(width=0)
-                })
-            
-            # Active SELL volume bar (red, extends left from center)
-            if sell_vol > 0:
-                bar_width = (sell_vol / max_volume) * max_bar_width
-                shapes.append({
-                    'type': 'rect',
-                    'x0': coords['volume_profile_center'] - bar_width,
-                    'x1': coords['volume_profile_center'],
-                    'y0': execution_price - price_step/2,
-                    'y1': execution_price + price_step/2,
-                    'fillcolor': 'red',
-                    'opacity': 0.7,
-                    'line': dict(width=0)
-                })
-        
-        return shapes
+        # Only emit bars for price levels that actually traded
+        buy_bins = np.flatnonzero(buy_volumes > 0)
+        sell_bins = np.flatnonzero(sell_volumes > 0)
+        buy_widths = (buy_volumes[buy_bins] / max_volume) * max_bar_width
+        sell_widths = (sell_volumes[sell_bins] / max_volume) * max_bar_width
+        
+        # Active BUY volume bars (green, extend right from center)
+        # Active SELL volume bars (red, extend left from center)
+        return go.Bar(
+            x=np.concatenate([buy_widths, sell_widths]),
+            y=np.concatenate([base_cents + buy_bins, base_cents + sell_bins]) / 100,
+            base=np.concatenate([
+                np.full(len(buy_bins), coords['volume_profile_center']),
+                coords['volume_profile_center'] - sell_widths
+            ]),
+            width=price_step,
+            orientation='h',
+            marker=dict(
+                color=['green'] * len(buy_bins) + ['red'] * len(sell_bins),
+                line=dict(width=0)
+            ),
+            opacity=0.7,
+            name='Volume Profile',
+            showlegend=False,
+            hoverinfo='skip'
+        )
     
     def create_bookmap(self, df: pd.DataFrame, symbol: str) -> go.Figure:
         """Create clean bookmap with pre-calculated coordinates"""
         # Calculate all coordinates
         coords = self.calculate_coordinates(df)
         
+        # Calculate tick-by-tick trade features once for all trade-based plots
+        features = self.calculate_tick_features(df)
+        
         # Create figure
         fig = go.Figure()
         
-        # Add support/resistance heatmap shapes
-        heatmap_shapes = self.create_support_resistance_heatmap(df, coords)
-        
-        # Add vertical volume bar shapes
-        volume_bar_shapes = self.create_vertical_volume_bars(df, coords)
-        
-        # Add horizontal volume profile shapes
-        volume_profile_shapes = self.create_horizontal_volume_profile(df, coords)
-        
-        # Combine all shapes
-        all_shapes = heatmap_shapes + volume_bar_shapes + volume_profile_shapes
+        # Add support/resistance heatmap (first, so it stays below everything else)
+        heatmap = self.create_support_resistance_heatmap(df, coords)
+        if heatmap:
+            fig.add_trace(heatmap)
         
         # Add best bid/ask lines
         if '买一价' in df.columns:
@@ -396,22 +434,32 @@ class CleanBookmapVisualizer:
             ))
         
         # Add VWAP line
-        vwap_line = self.calculate_vwap(df, coords)
+        vwap_line = self.calculate_vwap(df, coords, features)
         if vwap_line:
             fig.add_trace(vwap_line)
         
         # Add CVD plot
-        cvd_line, cvd_zero_line = self.calculate_cvd(df, coords)
+        cvd_line, cvd_zero_line = self.calculate_cvd(df, coords, features)
         if cvd_line:
             fig.add_trace(cvd_line)
         if cvd_zero_line:
             fig.add_trace(cvd_zero_line)
         
         # Add trade bubbles
-        trade_bubbles = self.create_trade_bubbles(df, coords)
+        trade_bubbles = self.create_trade_bubbles(df, coords, features)
         if trade_bubbles:
             fig.add_trace(trade_bubbles)
         
+        # Add vertical volume bars (last, drawn on top of the lines as the former shapes were)
+        volume_bars = self.create_vertical_volume_bars(df, coords, features)
+        if volume_bars:
+            fig.add_trace(volume_bars)
+        
+        # Add horizontal volume profile
+        volume_profile = self.create_horizontal_volume_profile(df, coords, features)
+        if volume_profile:
+            fig.add_trace(volume_profile)
+        
         # Update layout
         fig.update_layout(
             title=dict(
@@ -429,7 +477,7 @@ class CleanBookmapVisualizer:
                 bgcolor='rgba(0,0,0,0.5)',
                 font=dict(color='white')
             ),
-            shapes=all_shapes,
+            barmode='overlay',
             xaxis=dict(
                 title=dict(text='Time (Data Points)', font=dict(color='white')),
                 range=[0, coords['total_chart_width']],
@@ -446,60 +494,32 @@ class CleanBookmapVisualizer:
         
         return fig
     
-    def create_trade_bubbles(self, df: pd.DataFrame, coords: dict):
+    def create_trade_bubbles(self, df: pd.DataFrame, coords: dict, features: dict):
         """Create trade bubble scatter positioned at actual execution prices (bid/ask)"""
-        # Calculate volume changes
-        volume_diff = df['成交量'].diff()
-        price_diff = df['最新价'].diff()
-        
         # Filter significant trades
-        significant_mask = (volume_diff > 50) & ~volume_diff.isna()
+        significant_mask = features['significant_mask']
         
         if not significant_mask.any():
             return None
         
         # Get trade data
         trade_indices = coords['time_coords'][significant_mask]
-        trade_volumes = volume_diff[significant_mask]
-        trade_price_changes = price_diff[significant_mask]
-        
-        # Convert to arrays for consistent indexing
-        assert isinstance(trade_price_changes, pd.Series)
-        trade_price_changes_array = trade_price_changes.values
+        trade_volumes = features['volume_diff'][significant_mask]
+        trade_price_changes = features['price_diff'][significant_mask]
         
         # Position bubbles at actual execution prices
-        # Active BUY orders execute at ASK price (卖一价) - taking liquidity from sellers
-        # Active SELL orders execute at BID price (买一价) - taking liquidity from buyers
-        execution_prices = []
-        trade_types = []
+        is_buy = features['is_buy'][significant_mask]
+        estimated = features['estimated'][significant_mask]
+        execution_prices = features['execution_prices'][significant_mask]
         
-        for i, idx in enumerate(trade_indices):
-            price_change = trade_price_changes_array[i]
-            
-            if price_change > 0:
-                # Positive price change = Active BUY = executed at ASK price
-                if '卖一价' in df.columns and not pd.isna(df['卖一价'].iloc[idx]):
-                    execution_price = df['卖一价'].iloc[idx]
-                    trade_type = 'Active BUY'
-                else:
-                    execution_price = df['最新价'].iloc[idx]
-                    trade_type = 'BUY (est.)'
-            else:
-                # Negative price change = Active SELL = executed at BID price  
-                if '买一价' in df.columns and not pd.isna(df['买一价'].iloc[idx]):
-                    execution_price = df['买一价'].iloc[idx]
-                    trade_type = 'Active SELL'
-                else:
-                    execution_price = df['最新价'].iloc[idx]
-                    trade_type = 'SELL (est.)'
-            
-            execution_prices.append(execution_price)
-            trade_types.append(trade_type)
+        # Label trades by indexing a table of the four trade types (no per-trade string building)
+        trade_type_labels = np.array(['Active SELL', 'SELL (est.)', 'Active BUY', 'BUY (est.)'])
+        trade_types = trade_type_labels[is_buy.astype(np.intp) * 2 + estimated]
         
-        # Size and color bubbles
+        # Size and color bubbles (all per-trade attributes stay NumPy arrays)
         max_volume = trade_volumes.max()
         sizes = (trade_volumes / max_volume) * 20 + 5  # Size 5-25
-        colors = ['green' if pc > 0 else 'red' for pc in trade_price_changes]
+        colors = np.where(is_buy, 'green', 'red')
         
         return go.Scatter(
             x=trade_indices,
@@ -513,54 +533,34 @@ class CleanBookmapVisualizer:
             ),
             name='Trades',
             showlegend=False,
-            hovertemplate='%{customdata[1]}<br>Execution Price: %{y}<br>Volume: %{text}<br>Price Change: %{customdata[0]}<extra></extra>',
+            hovertemplate='%{hovertext}<br>Execution Price: %{y}<br>Volume: %{text}<br>Price Change: %{customdata:.3~f}<extra></extra>',
             text=trade_volumes,
-            customdata=list(zip(trade_price_changes, trade_types))
+            hovertext=trade_types,
+            customdata=trade_price_changes
         )
     
-    def calculate_vwap(self, df: pd.DataFrame, coords: dict):
+    def calculate_vwap(self, df: pd.DataFrame, coords: dict, features: dict):
         """Calculate and create VWAP (Volume Weighted Average Price) line"""
-        # Calculate volume deltas (actual traded volumes)
-        volume_diff = df['成交量'].diff()
+        # Volume deltas are the actual traded volumes
+        prices = features['last_prices']
+        volume_diff = features['volume_diff']
         
-        # Initialize arrays for VWAP calculation
-        cumulative_pv = 0  # cumulative price * volume
-        cumulative_volume = 0  # cumulative volume
-        vwap_values = []
-        valid_indices = []
-        
-        for i in range(len(df)):
-            current_price = df['最新价'].iloc[i]
-            
-            if i == 0:
-                # First data point - no volume change yet
-                vwap_values.append(current_price)
-                valid_indices.append(i)
-                continue
-            
-            volume_delta = volume_diff.iloc[i]
-            
-            # Only include meaningful volume changes
-            if pd.notna(volume_delta) and volume_delta > 0:
-                cumulative_pv += current_price * volume_delta
-                cumulative_volume += volume_delta
-            
-            # Calculate VWAP
-            if cumulative_volume > 0:
-                vwap = cumulative_pv / cumulative_volume
-                vwap_values.append(vwap)
-                valid_indices.append(i)
-            else:
-                # If no volume yet, use current price
-                vwap_values.append(current_price)
-                valid_indices.append(i)
-        
-        if not vwap_values:
+        if len(prices) == 0:
             return None
         
+        # Only include meaningful volume changes
+        valid = np.isfinite(volume_diff) & (volume_diff > 0)
+        cumulative_pv = np.cumsum(np.where(valid, prices * volume_diff, 0.0))  # cumulative price * volume
+        cumulative_volume = np.cumsum(np.where(valid, volume_diff, 0.0))  # cumulative volume
+        
+        # If no volume yet, use current price
+        vwap_values = np.where(cumulative_volume > 0, cumulative_pv / np.maximum(cumulative_volume, 1e-12), prices)
+        # First data point - no volume change yet
+        vwap_values[0] = prices[0]
+        
         # Create VWAP line trace
         return go.Scatter(
-            x=[coords['time_coords'][i] for i in valid_indices],
+            x=coords['time_coords'],
             y=vwap_values,
             mode='lines',
             line=dict(
@@ -573,64 +573,41 @@ class CleanBookmapVisualizer:
             hovertemplate='VWAP: %{y:.3f}<extra></extra>'
         )
     
-    def calculate_cvd(self, df: pd.DataFrame, coords: dict):
+    def calculate_cvd(self, df: pd.DataFrame, coords: dict, features: dict):
         """Calculate and create CVD (Cumulative Volume Delta) line"""
-        # Calculate volume deltas and price changes
-        volume_diff = df['成交量'].diff()
-        price_diff = df['最新价'].diff()
-        
-        # Initialize CVD calculation
-        cumulative_delta = 0
-        cvd_values = []
-        valid_indices = []
-        
-        for i in range(len(df)):
-            if i == 0:
-                # First data point
-                cvd_values.append(0)
-                valid_indices.append(i)
-                continue
-                
-            volume_delta = volume_diff.iloc[i]
-            price_change = price_diff.iloc[i]
-            
-            # Only include meaningful volume changes
-            if pd.notna(volume_delta) and pd.notna(price_change) and volume_delta > 0:
-                if price_change > 0:
-                    # Price up = buying pressure (positive CVD)
-                    cumulative_delta += volume_delta
-                elif price_change < 0:
-                    # Price down = selling pressure (negative CVD)
-                    cumulative_delta -= volume_delta
-                # price_change == 0: neutral, no CVD change
-            
-            cvd_values.append(cumulative_delta)
-            valid_indices.append(i)
-        
-        if not cvd_values or all(v == 0 for v in cvd_values):
+        # Volume deltas and price changes
+        volume_diff = features['volume_diff']
+        price_diff = features['price_diff']
+        
+        # Only include meaningful volume changes
+        # Price up = buying pressure (positive CVD), price down = selling pressure (negative CVD)
+        # price_change == 0: neutral, no CVD change
+        valid = np.isfinite(volume_diff) & (volume_diff > 0) & np.isfinite(price_diff)
+        signed_volume = np.where(valid, np.sign(price_diff) * volume_diff, 0.0)
+        cvd_values = np.cumsum(signed_volume)
+        
+        if len(cvd_values) == 0 or not cvd_values.any():
             return None, None
         
+        cvd_min = cvd_values.min()
+        cvd_max = cvd_values.max()
+        
         # Scale CVD to fit in the volume bar area (below main chart)
-        cvd_range = max(cvd_values) - min(cvd_values)
+        cvd_range = cvd_max - cvd_min
         if cvd_range == 0:
             return None, None
             
         # Map CVD to volume bar area coordinates
-        cvd_scaled = []
-        for cvd in cvd_values:
-            # Normalize CVD to 0-1 range
-            normalized = (cvd - min(cvd_values)) / cvd_range
-            # Scale to volume bar area (using 80% of the height)
-            scaled_y = coords['volume_bar_y_base'] + (normalized * coords['volume_bar_height'] * 0.8)
-            cvd_scaled.append(scaled_y)
+        # Normalize CVD to 0-1 range, then scale to volume bar area (using 80% of the height)
+        normalized = (cvd_values - cvd_min) / cvd_range
+        cvd_scaled = coords['volume_bar_y_base'] + normalized * coords['volume_bar_height'] * 0.8
         
         # Calculate zero line position
-        zero_position = min(cvd_values)
-        zero_normalized = (0 - zero_position) / cvd_range if 0 >= min(cvd_values) and 0 <= max(cvd_values) else None
+        zero_normalized = (0 - cvd_min) / cvd_range if cvd_min <= 0 <= cvd_max else None
         
         # Create CVD line trace
         cvd_line = go.Scatter(
-            x=[coords['time_coords'][i] for i in valid_indices],
+            x=coords['time_coords'],
             y=cvd_scaled,
             mode='lines',
             line=dict(
@@ -717,13 +694,19 @@ class CleanBookmapVisualizer:
         
         print(f"Found {len(csv_files)} CSV files")
         
-        for csv_file in csv_files:
-            try:
-                filepath = os.path.join(data_dir, csv_file)
-                self.process_file(filepath)
-                print()  # Empty line between files
-            except Exception as e:
-                print(f"Error processing {csv_file}: {str(e)}")
+        # Files are independent, so process them in parallel
+        filepaths = [os.path.join(data_dir, csv_file) for csv_file in csv_files]
+        num_processes = min(mp.cpu_count(), len(filepaths))
+        with mp.Pool(processes=num_processes) as pool:
+            pool.map(self._process_file_safe, filepaths)
+    
+    def _process_file_safe(self, filepath: str):
+        """Process a single file in a worker, reporting errors instead of raising"""
+        try:
+            self.process_file(filepath)
+            print()  # Empty line between files
+        except Exception as e:
+            print(f"Error processing {os.path.basename(filepath)}: {str(e)}")
 
 def main():
     print("Clean Bookmap Visualizer")